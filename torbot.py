@@ -1,23 +1,33 @@
+import io
 import os
+import queue
 import random
+import hmac
+import time
 import asyncio
 import logging
-from logging.handlers import RotatingFileHandler
+import atexit
+import threading
+import functools
+import concurrent.futures
+from collections import OrderedDict
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from typing import Optional
 from dotenv import load_dotenv
 
-import nest_asyncio
-nest_asyncio.apply()
-
+import stem
 from stem import Signal
 from stem.control import Controller
-from telegram import Update, InlineQueryResultArticle, InputTextMessageContent
+from telegram import Update, User, InlineQueryResultArticle, InputTextMessageContent
 from telegram.ext import (
+    AIORateLimiter,
     ApplicationBuilder,
     Application,
     CommandHandler,
     ContextTypes,
     InlineQueryHandler,
+    ApplicationHandlerStop,
+    filters,
     JobQueue,
     Job,
 )
@@ -31,313 +41,390 @@ logger.setLevel(logging.INFO)
 file_handler = RotatingFileHandler('bot.log', maxBytes=5*1024*1024, backupCount=2)
 file_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 file_handler.setFormatter(file_formatter)
-logger.addHandler(file_handler)
 
 console_handler = logging.StreamHandler()
 console_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 console_handler.setFormatter(console_formatter)
-logger.addHandler(console_handler)
+
+# Handlers only enqueue records; file and console writes happen on the listener thread
+_log_queue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(_log_queue))
+_log_listener = QueueListener(_log_queue, file_handler, console_handler, respect_handler_level=True)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 
 import telegram
-logger.info(f"python-telegram-bot version: {telegram.__version__}")
+logger.info("python-telegram-bot version: %s", telegram.__version__)
 
 # Load environment variables
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN') # it takes from .env file
 AUTH_PASSWORD = os.getenv('AUTH_PASSWORD', 'AUTHENTICATE_PASSWORD_MUST_BE_HERE')
+_AUTH_PASSWORD_BYTES = AUTH_PASSWORD.strip().encode()
 TOR_CONTROL_PASSWORD = os.getenv('TOR_CONTROL_PASSWORD', 'YOUR_PASSWORD_MUST_BE_HERE')
 TOR_CONTROL_PORT = int(os.getenv('TOR_CONTROL_PORT', '9051'))
 ALLOWED_COUNTRIES_ENV = os.getenv('ALLOWED_COUNTRIES', 'NO,FI,DK,SE,IS,NL,DE,CA,CH,NZ,AU,BE,IE,EE,PT,LU,UY,TW,JP,KR')
 
 # Blocked user IDs
-BLOCKED_USER_IDS = {123456789, 987654321}
+BLOCKED_USER_IDS: frozenset[int] = frozenset({123456789, 987654321})
 
 # Don't look here too
 EASTER_EGG_FILE = 'easter_egg.mp3'  # Be sure that this file in the same dir with .py code
+_EASTER_EGG_BYTES: Optional[bytes] = None  # Read once in main()
+
+VALID_COUNTRIES = frozenset(map(str.upper, filter(None, map(str.strip, ALLOWED_COUNTRIES_ENV.split(',')))))
+
+# SETCONF arguments never change at runtime, so build them once
+_EXIT_CONF = {c: {'ExitNodes': f'{{{c}}}', 'StrictNodes': '1'} for c in VALID_COUNTRIES}
+_CLEAR_CONF = {'ExitNodes': '', 'StrictNodes': '0'}
+
+_HELP_TEXT = (
+    "<b>Available commands:</b>\n\n"
+    "/start - Start the bot.\n"
+    "/auth &lt;password&gt; - Authenticate to use protected commands.\n"
+    "/update - Update your Tor identity.\n"
+    "/setcountry &lt;country_code&gt; - Set your preferred country for Tor exit nodes (e.g., US, JP).\n"
+    "/reset - Reset your preferred country and update Tor identity without restrictions.\n"
+    "/countries - Show a list of available countries for selection.\n"
+    "/help - Show this help message."
+)
 
-VALID_COUNTRIES = set(country.strip().upper() for country in ALLOWED_COUNTRIES_ENV.split(',') if country.strip())
+_COUNTRIES_REPLY = f"Available countries:\n{', '.join(sorted(VALID_COUNTRIES))}"
 
-authenticated_users = {}
-user_preferences = {}
+authenticated_users: set[int] = set()
+USER_CACHE_LIMIT = 10_000
+user_preferences: OrderedDict[int, str] = OrderedDict()
 
 RATE_LIMIT = 5 * 60
-user_last_update = {}
+IDENTITY_UPDATE_INTERVAL = (2700, 4500)  # Seconds between periodic rotations, picked randomly
+user_last_update: OrderedDict[int, float] = OrderedDict()
+
+def _touch(od: OrderedDict, key, value, cap: int = USER_CACHE_LIMIT):
+    # Writes mark an entry as most recent; the least recently written one is evicted
+    od[key] = value
+    od.move_to_end(key)
+    if len(od) > cap:
+        od.popitem(last=False)
+
+# Single worker so Tor control port access is serialized between users
+_TOR_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+_controller: Optional[Controller] = None
+_controller_lock = threading.Lock()
+
+# Exit country last applied via SETCONF (None means cleared). The sentinel forces
+# the first call, and the first call after a reconnect, to always apply it.
+_NOT_APPLIED = object()
+_last_exit_country = _NOT_APPLIED
+
+def _get_controller() -> Controller:
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            controller = Controller.from_port(port=TOR_CONTROL_PORT)
+            try:
+                controller.authenticate(password=TOR_CONTROL_PASSWORD)
+            except Exception:
+                controller.close()
+                raise
+            _controller = controller
+            logger.info("Connected to Tor control port.")
+        return _controller
+
+def _drop_controller():
+    global _controller, _last_exit_country
+    with _controller_lock:
+        if _controller is not None:
+            _controller.close()
+            _controller = None
+        _last_exit_country = _NOT_APPLIED
+
+atexit.register(_drop_controller)
+
+def _apply_identity(controller: Controller, preferred_country: Optional[str]):
+    global _last_exit_country
+    target = preferred_country.upper() if preferred_country and preferred_country.upper() in VALID_COUNTRIES else None
+
+    if target != _last_exit_country:
+        if target:
+            controller.set_options(_EXIT_CONF[target])
+            logger.info("Set ExitNodes to country: %s", target)
+        else:
+            controller.set_options(_CLEAR_CONF)
+            logger.info("Cleared ExitNodes preferences.")
+        _last_exit_country = target
 
-def is_blocked(user_id: int) -> bool:
-    return user_id in BLOCKED_USER_IDS
+    controller.signal(Signal.NEWNYM)
 
-def update_identity(preferred_country: Optional[str] = None):
+def _update_identity_sync(preferred_country: Optional[str] = None):
     try:
-        with Controller.from_port(port=TOR_CONTROL_PORT) as controller:
-            controller.authenticate(password=TOR_CONTROL_PASSWORD)
-            if preferred_country and preferred_country.upper() in VALID_COUNTRIES:
-                controller.set_options({
-                    'ExitNodes': f'{{{preferred_country.upper()}}}',
-                    'StrictNodes': '1',
-                })
-                logger.info(f"Set ExitNodes to country: {preferred_country.upper()}")
-            else:
-                controller.set_options({
-                    'ExitNodes': '',
-                    'StrictNodes': '0',
-                })
-                logger.info("Cleared ExitNodes preferences.")
-
-            controller.signal(Signal.NEWNYM)
+        try:
+            _apply_identity(_get_controller(), preferred_country)
+        except (stem.SocketClosed, stem.ProtocolError) as e:
+            # Cached connection went stale (e.g. Tor restarted), reconnect once
+            logger.warning("Tor control connection lost (%s), reconnecting.", e)
+            _drop_controller()
+            _apply_identity(_get_controller(), preferred_country)
         logger.info("Tor identity updated successfully.")
     except Exception as e:
-        logger.error(f"Error while updating Tor identity: {e}")
+        logger.error("Error while updating Tor identity: %s", e)
         raise
 
+async def update_identity_async(preferred_country: Optional[str] = None):
+    # stem's Controller is blocking, so keep it off the event loop
+    await asyncio.get_running_loop().run_in_executor(_TOR_EXECUTOR, _update_identity_sync, preferred_country)
+
+# In-flight identity updates keyed by country, shared by concurrent callers
+_inflight: dict[Optional[str], asyncio.Task] = {}
+
+async def update_identity_coalesced(preferred_country: Optional[str] = None):
+    # Check-and-insert has no await in between, so it is atomic on the event loop
+    task = _inflight.get(preferred_country)
+    if task is None:
+        task = asyncio.ensure_future(update_identity_async(preferred_country))
+        _inflight[preferred_country] = task
+        task.add_done_callback(lambda _: _inflight.pop(preferred_country, None))
+    # Shield so one cancelled caller doesn't cancel the update for the others
+    await asyncio.shield(task)
+
+def with_user(fn):
+    """Resolve ``update.effective_user`` once and pass ``user_id`` and ``user`` to the handler."""
+    @functools.wraps(fn)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        user = update.effective_user
+        return await fn(update, context, user.id, user)
+    return wrapper
+
+
+# Blocked users are handled in group -1, before any command handler runs
+async def blocked_start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    message = update.effective_message
+    try:
+        if _EASTER_EGG_BYTES is not None:
+            # So yeah, it sends audio file.
+            await message.reply_audio(audio=io.BytesIO(_EASTER_EGG_BYTES), filename=EASTER_EGG_FILE)
+            logger.info("Easter egg sent to blocked user %s (ID: %d).", user.first_name, user.id)
+        else:
+            await message.reply_text('Easter egg file not found. Please call the administrator.')
+            logger.error("Easter egg file '%s' not found.", EASTER_EGG_FILE)
+    except Exception as e:
+        logger.error("Error in start command: %s", e)
+    # Always stop here, even if the reply failed, so group 0 never sees blocked users
+    raise ApplicationHandlerStop
 
-
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
+async def blocked_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    message = update.effective_message
     try:
-        if is_blocked(user_id):
-            if os.path.exists(EASTER_EGG_FILE):
-                with open(EASTER_EGG_FILE, 'rb') as audio_file:
-                    # So yeah, it sends audio file.
-                    await update.message.reply_audio(audio=audio_file)
-                logger.info(f"Easter egg sent to blocked user {update.effective_user.first_name} (ID: {user_id}).")
-            else:
-                await update.message.reply_text('Easter egg file not found. Please call the administrator.')
-                logger.error(f"Easter egg file '{EASTER_EGG_FILE}' not found.")
-            return
+        await message.reply_text('A?')
+        logger.info("Blocked user %s (ID: %d) attempted to use %s.", user.first_name, user.id, message.text.split()[0])
+    except Exception as e:
+        logger.error("Error replying to blocked user %s (ID: %d): %s", user.first_name, user.id, e)
+    raise ApplicationHandlerStop
 
+async def blocked_inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    if user.id not in BLOCKED_USER_IDS:
+        return
+    if update.inline_query.query:
+        try:
+            await context.bot.answer_inline_query(update.inline_query.id, [], cache_time=1)
+            logger.info("Blocked user %s (ID: %d) attempted to use inline query.", user.first_name, user.id)
+        except Exception as e:
+            logger.error("Error in inline query handler: %s", e)
+    raise ApplicationHandlerStop
+
+@with_user
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, user: User) -> None:
+    try:
         await update.message.reply_text(
             'Tor management bot. Use /auth <password> to authenticate.'
         )
-        logger.info(f"Bot started by user {update.effective_user.first_name} (ID: {user_id}).")
+        logger.info("Bot started by user %s (ID: %d).", user.first_name, user_id)
     except Exception as e:
-        logger.error(f"Error in start command: {e}")
+        logger.error("Error in start command: %s", e)
         await update.message.reply_text('An error occurred while processing your request.')
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
+@with_user
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, user: User) -> None:
     try:
-        if is_blocked(user_id):
-            await update.message.reply_text('A?')
-            logger.info(f"Blocked user {update.effective_user.first_name} (ID: {user_id}) attempted to use /help.")
-            return
-
-        help_text = (
-            "<b>Available commands:</b>\n\n"
-            "/start - Start the bot.\n"
-            "/auth &lt;password&gt; - Authenticate to use protected commands.\n"
-            "/update - Update your Tor identity.\n"
-            "/setcountry &lt;country_code&gt; - Set your preferred country for Tor exit nodes (e.g., US, JP).\n"
-            "/reset - Reset your preferred country and update Tor identity without restrictions.\n"
-            "/countries - Show a list of available countries for selection.\n"
-            "/help - Show this help message."
-        )
-        await update.message.reply_text(help_text, parse_mode='HTML')
-        logger.info(f"Help requested by user {update.effective_user.first_name} (ID: {user_id}).")
+        await update.message.reply_text(_HELP_TEXT, parse_mode='HTML')
+        logger.info("Help requested by user %s (ID: %d).", user.first_name, user_id)
     except Exception as e:
-        logger.error(f"Error in help command: {e}")
+        logger.error("Error in help command: %s", e)
         await update.message.reply_text('An error occurred while generating the help message.')
 
-async def auth_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
+@with_user
+async def auth_command(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, user: User) -> None:
     try:
-        if is_blocked(user_id):
-            await update.message.reply_text('A?')
-            logger.info(f"Blocked user {update.effective_user.first_name} (ID: {user_id}) attempted to use /auth.")
-            return
-
         if user_id in authenticated_users:
             await update.message.reply_text('You are already authenticated.')
-            logger.info(f"User {update.effective_user.first_name} (ID: {user_id}) attempted to re-authenticate.")
+            logger.info("User %s (ID: %d) attempted to re-authenticate.", user.first_name, user_id)
             return
 
         if len(context.args) != 1:
             await update.message.reply_text('Usage: /auth <password>')
-            logger.warning(f"User {update.effective_user.first_name} (ID: {user_id}) used incorrect /auth command format.")
+            logger.warning("User %s (ID: %d) used incorrect /auth command format.", user.first_name, user_id)
             return
 
-        input_password = context.args[0].strip()
-        correct_password = AUTH_PASSWORD.strip()
-
-        if input_password == correct_password:
-            authenticated_users[user_id] = True
+        # Constant-time comparison so response timing doesn't leak the password
+        if hmac.compare_digest(context.args[0].strip().encode(), _AUTH_PASSWORD_BYTES):
+            authenticated_users.add(user_id)
             await update.message.reply_text('Authentication successful! Now you can use commands.')
-            logger.info(f"User {update.effective_user.first_name} (ID: {user_id}) authenticated successfully.")
+            logger.info("User %s (ID: %d) authenticated successfully.", user.first_name, user_id)
         else:
             await update.message.reply_text('Incorrect password. Please try again.')
-            logger.warning(f"User {update.effective_user.first_name} (ID: {user_id}) failed authentication.")
+            logger.warning("User %s (ID: %d) failed authentication.", user.first_name, user_id)
     except Exception as e:
-        logger.error(f"Error in auth command: {e}")
+        logger.error("Error in auth command: %s", e)
         await update.message.reply_text('An error occurred during authentication.')
 
-async def update_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-
+@with_user
+async def update_command(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, user: User) -> None:
     try:
-        if is_blocked(user_id):
-            await update.message.reply_text('You are not allowed to use this bot.')
-            logger.info(f"Blocked user {update.effective_user.first_name} (ID: {user_id}) attempted to use /update.")
-            return
-
         if user_id not in authenticated_users:
             await update.message.reply_text(
                 'You are not authenticated! Please authenticate using /auth <password>.'
             )
-            logger.info(f"Unauthenticated user {update.effective_user.first_name} (ID: {user_id}) attempted to update identity.")
+            logger.info("Unauthenticated user %s (ID: %d) attempted to update identity.", user.first_name, user_id)
             return
 
-        current_time = asyncio.get_event_loop().time()
-        last_update = user_last_update.get(user_id, 0)
-        if current_time - last_update < RATE_LIMIT:
-            wait_time = RATE_LIMIT - (current_time - last_update)
+        current_time = time.monotonic()
+        last_update = user_last_update.get(user_id)
+        if last_update is not None and current_time - last_update < RATE_LIMIT:
             await update.message.reply_text(
-                f'Please wait {int(wait_time)} seconds before the next update.'
+                f'Please wait {int(RATE_LIMIT - (current_time - last_update))} seconds before the next update.'
             )
-            logger.info(f"User {update.effective_user.first_name} (ID: {user_id}) is rate limited for /update.")
+            logger.info("User %s (ID: %d) is rate limited for /update.", user.first_name, user_id)
             return
 
         preferred_country = user_preferences.get(user_id)
 
-        update_identity(preferred_country)
-        user_last_update[user_id] = current_time
+        await update_identity_coalesced(preferred_country)
+        _touch(user_last_update, user_id, current_time)
         await update.message.reply_text('Your Tor identity has been updated!')
-        logger.info(f"User {update.effective_user.first_name} (ID: {user_id}) updated their Tor identity.")
+        logger.info("User %s (ID: %d) updated their Tor identity.", user.first_name, user_id)
     except Exception as e:
-        logger.error(f"Error in update command: {e}")
+        logger.error("Error in update command: %s", e)
         await update.message.reply_text('An error occurred while updating your identity.')
 
-async def set_country_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-
+@with_user
+async def set_country_command(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, user: User) -> None:
     try:
-        if is_blocked(user_id):
-            await update.message.reply_text('A?')
-            logger.info(f"Blocked user {update.effective_user.first_name} (ID: {user_id}) attempted to use /setcountry.")
-            return
-
         if user_id not in authenticated_users:
             await update.message.reply_text(
                 'You are not authenticated! Please authenticate using /auth <password>.'
             )
-            logger.info(f"Unauthenticated user {update.effective_user.first_name} (ID: {user_id}) attempted to set country.")
+            logger.info("Unauthenticated user %s (ID: %d) attempted to set country.", user.first_name, user_id)
             return
 
         if len(context.args) != 1:
             await update.message.reply_text('Usage: /setcountry <country_code>')
-            logger.warning(f"User {update.effective_user.first_name} (ID: {user_id}) used incorrect /setcountry command format.")
+            logger.warning("User %s (ID: %d) used incorrect /setcountry command format.", user.first_name, user_id)
             return
 
         country_code = context.args[0].upper()
-        if country_code not in VALID_COUNTRIES:
+        # Cheap shape check first so typos skip the set lookup
+        if len(country_code) != 2 or not country_code.isalpha() or country_code not in VALID_COUNTRIES:
             await update.message.reply_text(
                 'Invalid country code. Please use a two letter ISO code of country (e.g., US, JP, KR).'
             )
-            logger.warning(f"User {update.effective_user.first_name} (ID: {user_id}) provided invalid country code: {country_code}.")
+            logger.warning("User %s (ID: %d) provided invalid country code: %s.", user.first_name, user_id, country_code)
             return
 
-        user_preferences[user_id] = country_code
+        _touch(user_preferences, user_id, country_code)
         await update.message.reply_text(f'Preferred country set to: {country_code}')
-        logger.info(f"User {update.effective_user.first_name} (ID: {user_id}) set preferred country to {country_code}.")
+        logger.info("User %s (ID: %d) set preferred country to %s.", user.first_name, user_id, country_code)
     except Exception as e:
-        logger.error(f"Error in set_country command: {e}")
+        logger.error("Error in set_country command: %s", e)
         await update.message.reply_text('An error occurred while setting your preferred country.')
 
-async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-
+@with_user
+async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, user: User) -> None:
     try:
-        if is_blocked(user_id):
-            await update.message.reply_text('A?')
-            logger.info(f"Blocked user {update.effective_user.first_name} (ID: {user_id}) attempted to use /reset.")
-            return
-
         if user_id not in authenticated_users:
             await update.message.reply_text(
                 'You are not authenticated! Please authenticate using /auth <password>.'
             )
-            logger.info(f"Unauthenticated user {update.effective_user.first_name} (ID: {user_id}) attempted to reset preferences.")
+            logger.info("Unauthenticated user %s (ID: %d) attempted to reset preferences.", user.first_name, user_id)
             return
 
-        current_time = asyncio.get_event_loop().time()
-        last_update = user_last_update.get(user_id, 0)
-        if current_time - last_update < RATE_LIMIT:
-            wait_time = RATE_LIMIT - (current_time - last_update)
+        current_time = time.monotonic()
+        last_update = user_last_update.get(user_id)
+        if last_update is not None and current_time - last_update < RATE_LIMIT:
             await update.message.reply_text(
-                f'Please wait {int(wait_time)} seconds before the next update.'
+                f'Please wait {int(RATE_LIMIT - (current_time - last_update))} seconds before the next update.'
             )
-            logger.info(f"User {update.effective_user.first_name} (ID: {user_id}) is rate limited for /reset.")
+            logger.info("User %s (ID: %d) is rate limited for /reset.", user.first_name, user_id)
             return
 
         if user_id in user_preferences:
             del user_preferences[user_id]
-            logger.info(f"User {update.effective_user.first_name} (ID: {user_id}) reset their country preference.")
+            logger.info("User %s (ID: %d) reset their country preference.", user.first_name, user_id)
 
-        update_identity()
-        user_last_update[user_id] = current_time
+        await update_identity_coalesced()
+        _touch(user_last_update, user_id, current_time)
         await update.message.reply_text('Your country preferences have been reset and Tor identity updated!')
-        logger.info(f"User {update.effective_user.first_name} (ID: {user_id}) reset preferences and updated Tor identity.")
+        logger.info("User %s (ID: %d) reset preferences and updated Tor identity.", user.first_name, user_id)
     except Exception as e:
-        logger.error(f"Error in reset command: {e}")
+        logger.error("Error in reset command: %s", e)
         await update.message.reply_text('An error occurred while resetting your preferences.')
 
-async def countries_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
+@with_user
+async def countries_command(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, user: User) -> None:
     try:
-        if is_blocked(user_id):
-            await update.message.reply_text('You are not allowed to use this bot.')
-            logger.info(f"Blocked user {update.effective_user.first_name} (ID: {user_id}) attempted to use /countries.")
-            return
-
         if user_id not in authenticated_users:
             await update.message.reply_text(
                 'You are not authenticated! Please authenticate using /auth <password>.'
             )
-            logger.info(f"Unauthenticated user {update.effective_user.first_name} (ID: {user_id}) attempted to use /countries.")
+            logger.info("Unauthenticated user %s (ID: %d) attempted to use /countries.", user.first_name, user_id)
             return
 
         if len(context.args) > 0:
             await update.message.reply_text('Usage: /countries')
-            logger.warning(f"User {update.effective_user.first_name} (ID: {user_id}) used incorrect /countries command format.")
+            logger.warning("User %s (ID: %d) used incorrect /countries command format.", user.first_name, user_id)
             return
 
-        countries_list = ', '.join(sorted(VALID_COUNTRIES))
-        await update.message.reply_text(
-            f"Available countries:\n{countries_list}",
-            parse_mode='HTML'
-        )
-        logger.info(f"Countries list requested by user {update.effective_user.first_name} (ID: {user_id}).")
+        await update.message.reply_text(_COUNTRIES_REPLY, parse_mode='HTML')
+        logger.info("Countries list requested by user %s (ID: %d).", user.first_name, user_id)
     except Exception as e:
-        logger.error(f"Error in countries command: {e}")
+        logger.error("Error in countries command: %s", e)
         await update.message.reply_text('An error occurred while fetching the countries list.')
 
-async def inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+@with_user
+async def inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, user: User) -> None:
     query = update.inline_query.query
     if not query:
         return
 
-    user_id = update.effective_user.id
     try:
-        if is_blocked(user_id):
-            await context.bot.answer_inline_query(update.inline_query.id, [], cache_time=1)
-            logger.info(f"Blocked user {update.effective_user.first_name} (ID: {user_id}) attempted to use inline query.")
-            return
-
-        update_identity()
+        await update_identity_coalesced()
         result = InlineQueryResultArticle(
             id='1',
             title='Update Tor Identity',
             input_message_content=InputTextMessageContent('Your Tor identity has been updated!')
         )
         await context.bot.answer_inline_query(update.inline_query.id, [result], cache_time=1)
-        logger.info(f"Inline query handled by user {update.effective_user.first_name} (ID: {user_id}).")
+        logger.info("Inline query handled by user %s (ID: %d).", user.first_name, user_id)
     except Exception as e:
-        logger.error(f"Error in inline query handler: {e}")
+        logger.error("Error in inline query handler: %s", e)
 
 
 async def tor_identity_update_job(context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
-        update_identity()
+        await update_identity_coalesced()
         logger.info("Periodic Tor identity update completed.")
     except Exception as e:
-        logger.error(f"Error during periodic Tor identity update: {e}")
+        logger.error("Error during periodic Tor identity update: %s", e)
+
+    # Re-arm the same job with a fresh random interval so rotations stay unpredictable.
+    # If this fails the job keeps its previous interval, which is still in range.
+    next_interval = random.randint(*IDENTITY_UPDATE_INTERVAL)
+    try:
+        context.job.job.reschedule(trigger='interval', seconds=next_interval)
+        logger.info("Scheduled next Tor identity update after %d seconds.", next_interval)
+    except Exception as e:
+        logger.error("Error while rescheduling periodic Tor identity update: %s", e)
 
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -346,12 +433,36 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
         await update.effective_message.reply_text('An error occurred. Please try again later.')
 
 
-async def main():
+def main():
     if not TELEGRAM_BOT_TOKEN:
         logger.error("TELEGRAM_BOT_TOKEN is not set. Exiting.")
         return
 
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    global _EASTER_EGG_BYTES
+    try:
+        with open(EASTER_EGG_FILE, 'rb') as f:
+            _EASTER_EGG_BYTES = f.read()
+    except OSError as e:
+        logger.warning("Could not load easter egg file '%s': %s", EASTER_EGG_FILE, e)
+        _EASTER_EGG_BYTES = None
+
+    # Throttle outgoing requests to Telegram's limits instead of retrying on 429
+    rate_limiter = AIORateLimiter(
+        overall_max_rate=30,
+        overall_time_period=1,
+        group_max_rate=20,
+        group_time_period=60,
+        max_retries=3,
+    )
+    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).rate_limiter(rate_limiter).build()
+
+    blocked_users = filters.User(user_id=BLOCKED_USER_IDS)
+    application.add_handler(CommandHandler("start", blocked_start_handler, filters=blocked_users), group=-1)
+    application.add_handler(
+        CommandHandler(["help", "auth", "update", "setcountry", "reset", "countries"], blocked_command_handler, filters=blocked_users),
+        group=-1,
+    )
+    application.add_handler(InlineQueryHandler(blocked_inline_query_handler), group=-1)
 
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("help", help_command))
@@ -367,19 +478,20 @@ async def main():
     job_queue: JobQueue = application.job_queue
 
     # It sometimes updating your identify randomly between some time
-    initial_interval = random.randint(2700, 4500)
-    job_queue.run_once(tor_identity_update_job, initial_interval)
-    logger.info(f"Scheduled first Tor identity update after {initial_interval} seconds.")
+    initial_interval = random.randint(*IDENTITY_UPDATE_INTERVAL)
+    job_queue.run_repeating(tor_identity_update_job, interval=random.randint(*IDENTITY_UPDATE_INTERVAL), first=initial_interval)
+    logger.info("Scheduled first Tor identity update after %d seconds.", initial_interval)
 
     logger.info("Starting bot")
-    await application.run_polling()
+    # run_polling owns the event loop, so main() must not run inside one
+    application.run_polling()
 
 if __name__ == '__main__':
     try:
-        asyncio.run(main())
+        main()
     except (KeyboardInterrupt, SystemExit):
         logger.info("Bot stopped by user.")
     except RuntimeError as e:
-        logger.error(f"RuntimeError: {e}")
+        logger.error("RuntimeError: %s", e)
     except Exception as e:
-        logger.error(f"Unexpected error: {e}")
+        logger.error("Unexpected error: %s", e)